@@ -5,13 +5,17 @@ import tempfile
 import nibabel
 import numpy
 
+import compression
+
 def by_p_value(z_map, mask, score_threshold, max_p_value, clusters):
     smoothness = subprocess.check_output(["smoothest", "-z", z_map, "-m", mask])
     smoothness = dict(x.split(" ", 1) for x in smoothness.decode().splitlines())
     
     with tempfile.TemporaryDirectory() as directory:
-        input = os.path.join(directory, "input.nii.gz")
-        output = os.path.join(directory, "output.nii.gz")
+        input = os.path.join(
+            directory, "input"+compression.intermediate_suffix)
+        output = os.path.join(
+            directory, "output"+compression.intermediate_suffix)
         
         command = _get_base_cluster_command(input, score_threshold, output)
         command.extend([
@@ -21,18 +25,20 @@ def by_p_value(z_map, mask, score_threshold, max_p_value, clusters):
             "--pthresh={}".format(max_p_value)])
         
         clusters_image = _run(command, nibabel.load(z_map), input, output)
-        nibabel.save(clusters_image, clusters)
+        compression.save(clusters_image, clusters)
 
 def by_size(score_map, score_threshold, min_size, clusters):
     with tempfile.TemporaryDirectory() as directory:
-        input = os.path.join(directory, "input.nii.gz")
-        output = os.path.join(directory, "output.nii.gz")
+        input = os.path.join(
+            directory, "input"+compression.intermediate_suffix)
+        output = os.path.join(
+            directory, "output"+compression.intermediate_suffix)
         
         command = _get_base_cluster_command(input, score_threshold, output)
         command.append("--minextent={}".format(min_size))
         
         clusters_image = _run(command, nibabel.load(score_map), input, output)
-        nibabel.save(clusters_image, clusters)
+        compression.save(clusters_image, clusters)
 
 def _get_base_cluster_command(source, threshold, output):
     command = [
@@ -44,12 +50,21 @@ def _get_base_cluster_command(source, threshold, output):
 def _run(command, image, input, output):
     data = image.get_fdata()
     
-    nibabel.save(nibabel.Nifti1Image(data, image.affine), input)
-    subprocess.check_output(command)
-    positive = nibabel.load(output).get_fdata()
+    # Make sure FSL writes the output in the format given by its extension
+    output_type = "NIFTI_GZ" if compression.is_compressed(output) else "NIFTI"
+    env = dict(os.environ, FSLOUTPUTTYPE=output_type)
+    
+    compression.save(
+        nibabel.Nifti1Image(data, image.affine), input,
+        compression.intermediate_level)
+    subprocess.check_output(command, env=env)
+    # NOTE: output is overwritten by the next run, do not memory-map it
+    positive = nibabel.load(output, mmap=False).get_fdata()
     
-    nibabel.save(nibabel.Nifti1Image(-data, image.affine), input)
-    subprocess.check_output(command)
+    compression.save(
+        nibabel.Nifti1Image(-data, image.affine), input,
+        compression.intermediate_level)
+    subprocess.check_output(command, env=env)
     negative = nibabel.load(output).get_fdata()
     
     return nibabel.Nifti1Image(numpy.abs(positive - negative), image.affine)
@@ -0,0 +1,173 @@
+""" Pipeline-wide output policy for NIfTI images.
+
+    Intermediate images are read once by the next stage and then discarded:
+    they are written uncompressed by default. Final products are kept and
+    shared: they are gzip-compressed, using several threads on independent
+    blocks for large images. The module-level settings may be changed before
+    the pipeline is built; the scripts run by the pipeline receive them as
+    command-line options (see add_arguments and options).
+    
+    Images written by external tools (ITK, ANTs, FSL) follow the suffix of
+    their target. When a compressed final product is written by such a tool,
+    the task has it write an uncompressed file, then compresses it with copy.
+"""
+
+import concurrent.futures
+import gzip
+import os
+import re
+import shutil
+import uuid
+
+import nibabel
+
+# Suffixes of intermediate and final images
+intermediate_suffix = ".nii"
+final_suffix = ".nii.gz"
+
+# zlib compression levels (1: fastest, 9: smallest) of final and intermediate
+# images, the latter only being used if intermediate_suffix is compressed.
+final_level = 6
+intermediate_level = 1
+
+# Number of compression threads, None to use all available CPUs
+threads = None
+
+# Size of independently-compressed blocks, in bytes
+block_size = 16*2**20
+
+def suffix(final):
+    """ Return the suffix of intermediate or final images. """
+    
+    return final_suffix if final else intermediate_suffix
+
+def is_compressed(path):
+    """ Test whether the path designates a gzip-compressed file. """
+    
+    return str(path).endswith(".gz")
+
+def with_suffix(path, suffix):
+    """ Replace the NIfTI extension of path (if any) by suffix. """
+    
+    return re.sub(r"(?:\.nii(?:\.gz)?)?$", suffix, str(path), count=1)
+
+def add_arguments(parser):
+    """ Add the command-line options of the output policy to an argparse
+        parser.
+    """
+    
+    group = parser.add_argument_group("compression")
+    group.add_argument(
+        "--level", type=int, default=final_level,
+        help="Compression level of .nii.gz outputs, defaults to %(default)s")
+    group.add_argument(
+        "--threads", type=int, default=threads,
+        help="Number of compression threads, defaults to all available CPUs")
+    group.add_argument(
+        "--block-size", type=int, default=block_size,
+        help="Size in bytes of independently-compressed blocks, "
+            "defaults to %(default)s")
+
+def configure(arguments):
+    """ Set the output policy from the options parsed by a parser passed to
+        add_arguments.
+    """
+    
+    global threads, block_size
+    threads = arguments.threads
+    block_size = arguments.block_size
+
+def options(level=None):
+    """ Return the command-line options passing the output policy, with the
+        given compression level, to a script using add_arguments.
+    """
+    
+    level = final_level if level is None else level
+    
+    options = ["--level", str(level), "--block-size", str(block_size)]
+    if threads is not None:
+        options.extend(["--threads", str(threads)])
+    return options
+
+def compress(data, level=None):
+    """ Compress data to gzip format. Data larger than block_size is split in
+        blocks compressed in parallel and stored as consecutive gzip members.
+        Readers based on zlib's gzread (ITK, FSL), Python's gzip module and
+        pigz decode them as a single stream.
+    """
+    
+    level = final_level if level is None else level
+    
+    if len(data) <= block_size:
+        return gzip.compress(data, level)
+    
+    # NOTE: slice a view to avoid copying each block
+    data = memoryview(data)
+    blocks = [
+        data[start:start+block_size]
+        for start in range(0, len(data), block_size)]
+    # NOTE: zlib releases the GIL, threads are enough here.
+    with concurrent.futures.ThreadPoolExecutor(_threads()) as executor:
+        members = executor.map(lambda x: gzip.compress(x, level), blocks)
+        return b"".join(members)
+
+def save(image, path, level=None):
+    """ Save a NIfTI image according to the extension of path.
+    
+        The image is first written to a temporary file in the same directory,
+        then renamed: the source of the image may thus be the destination
+        path, as in the in-place reorientation steps.
+    """
+    
+    path = str(path)
+    if is_compressed(path):
+        # Header and data in a single buffer, as in a .nii file.
+        data = compress(image.to_bytes(), level)
+    else:
+        data = None
+    
+    # Create the temporary file like open does, i.e. following the umask
+    temporary = os.path.join(
+        os.path.dirname(os.path.abspath(path)),
+        ".{}.nii".format(uuid.uuid4().hex))
+    os.close(os.open(temporary, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o666))
+    try:
+        if data is None:
+            nibabel.save(image, temporary)
+        else:
+            with open(temporary, "wb") as fd:
+                fd.write(data)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+def copy(source, target, level=None):
+    """ Copy an image, (de)compressing it if the extensions of source and
+        target differ.
+    """
+    
+    source, target = str(source), str(target)
+    if is_compressed(source) == is_compressed(target):
+        shutil.copyfile(source, target)
+    elif is_compressed(source):
+        with gzip.open(source, "rb") as fd_source:
+            with open(target, "wb") as fd_target:
+                shutil.copyfileobj(fd_source, fd_target)
+    else:
+        with open(source, "rb") as fd:
+            data = fd.read()
+        with open(target, "wb") as fd:
+            fd.write(compress(data, level))
+
+def _threads():
+    """ Number of compression threads: the threads setting, or the number of
+        CPUs this process may run on (e.g. in a Slurm allocation).
+    """
+    
+    if threads is not None:
+        return threads
+    elif hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    else:
+        return os.cpu_count()
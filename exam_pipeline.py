@@ -1,5 +1,6 @@
 import inspect
-import spire.ants
+
+import compression
 import tasks
 
 class ExamPipeline(object):
@@ -27,21 +28,23 @@ class ExamPipeline(object):
         return self._get_task(
             tasks.Reorient,
             self.source, self.transforms, self.to_standard.targets[0], 
-            self.reference, self.destination/"reoriented.nii.gz")
+            self.reference, self._target("reoriented"),
+            compression.intermediate_level)
     
     @property
     def preprocessing(self):
         return self._get_task(
             tasks.BiasCorrection,
             self.reorientation.targets[0], 
-            self.destination/"reoriented_preprocessed.nii.gz")
+            self._target("reoriented_preprocessed"))
     
     @property
     def mirroring(self):
         return self._get_task(
             tasks.Mirror,
             self.preprocessing.targets[0], 
-            self.destination/"mirrored_preprocessed.nii.gz")
+            self._target("mirrored_preprocessed"),
+            compression.intermediate_level)
 
     @property
     def template(self):
@@ -58,7 +61,7 @@ class ExamPipeline(object):
         return self._get_task(
             tasks.JacobianDeterminant,
             self.template.targets[1], 
-            self.destination/"original_jacobian.nii.gz",
+            self._target("original_jacobian"),
             True)
     
     @property
@@ -66,7 +69,7 @@ class ExamPipeline(object):
         return self._get_task(
             tasks.JacobianDeterminant,
             self.template.targets[5], 
-            self.destination/"mirrored_jacobian.nii.gz",
+            self._target("mirrored_jacobian"),
             True)
 
     @property
@@ -74,15 +77,15 @@ class ExamPipeline(object):
         return self._get_task(
             tasks.Subtract,
             self.original_jacobian.targets[0], self.mirrored_jacobian.targets[0], 
-            self.destination/"asymmetry.nii.gz")
+            self._target("asymmetry", True))
     
     @property
     def asymmetry_to_cohort_template(self):
         return self._get_task(
-            spire.ants.ApplyTransforms,
+            tasks.ApplyTransforms,
             self.asymmetry.targets[0], 
             self.cohort_template, self.cohort_transforms,
-            self.destination/"asymmetry_in_cohort_template.nii.gz")
+            self._target("asymmetry_in_cohort_template", True))
     
     ############################################################################
     #                             Private interface                            #
@@ -94,6 +97,14 @@ class ExamPipeline(object):
             self._tasks[name] = class_(*args, **kwargs)
         return self._tasks[name]
     
+    def _target(self, name, final=False):
+        """ Path to an image in the destination directory, with a suffix
+            following the output policy of intermediate and final images.
+        """
+        
+        return self.destination/compression.with_suffix(
+            name, compression.suffix(final))
+    
     def _jacobian(self, source, target_prefix):
         
         return self._get_task(tasks.JacobianDeterminant, source, target, True)
@@ -9,6 +9,7 @@ import spire
 import yaml
 
 import clustering
+import compression
 import clusters_volume_report
 import welch
 
@@ -17,23 +18,33 @@ class ManualTransform(spire.TaskFactory):
         spire.TaskFactory.__init__(self, str(target))
         self.file_dep = [source, reference]
         self.targets = [target]
+        
+        tmp = compression.with_suffix("tmp", compression.intermediate_suffix)
+        level = compression.intermediate_level
         self.actions = (
             [
                 ["echo", "Save transform in", target],
-                ["cp", source, "tmp.nii.gz"]]
-            + [[x, "tmp.nii.gz", "tmp.nii.gz"] for x in grid_transforms]
+                (compression.copy, (source, tmp, level))]
+            + [
+                [x, tmp, tmp]+compression.options(level) 
+                for x in grid_transforms]
             + [
-                ["itksnap", "-g", reference, "-o", "tmp.nii.gz"],
-                ["rm", "tmp.nii.gz"]])
+                ["itksnap", "-g", reference, "-o", tmp],
+                ["rm", tmp]])
 
 class Reorient(spire.TaskFactory):
-    def __init__(self, source, grid_transforms, image_transform, reference, target):
+    def __init__(
+            self, source, grid_transforms, image_transform, reference, target,
+            level=None):
         spire.TaskFactory.__init__(self, str(target))
         self.file_dep = [source]
         self.targets = [target]
         
-        self.actions = [["cp", source, target]]
-        self.actions.extend([[x, target, target] for x in grid_transforms])
+        # NOTE: source and target may differ in compression
+        self.actions = [(compression.copy, (source, target, level))]
+        self.actions.extend([
+            [x, target, target]+compression.options(level) 
+            for x in grid_transforms])
         if image_transform is not None:
             self.actions.append(
                 [
@@ -49,11 +60,12 @@ class BiasCorrection(spire.TaskFactory):
         self.actions = [["N4BiasFieldCorrection", "-i", source, "-o", target]]
 
 class Mirror(spire.TaskFactory):
-    def __init__(self, source, target):
+    def __init__(self, source, target, level=None):
         spire.TaskFactory.__init__(self, str(target))
         self.file_dep = [source]
         self.targets = [target]
-        self.actions = [["lr-mirror", source, target]]
+        self.actions = [
+            ["lr-mirror", source, target]+compression.options(level)]
 
 class SymmetricSubjectTemplate(spire.TaskFactory):
     def __init__(self, original, mirrored, prefix):
@@ -103,11 +115,38 @@ class JacobianDeterminant(spire.TaskFactory):
             ]]
 
 class Subtract(spire.TaskFactory):
-    def __init__(self, lhs, rhs, target):
+    def __init__(self, lhs, rhs, target, level=None):
         spire.TaskFactory.__init__(self, str(target))
         self.file_dep = [lhs, rhs]
         self.targets = [target]
-        self.actions = [["ImageMath", "3", target, "-", lhs, rhs]]
+        
+        # Let ImageMath write an uncompressed image, compress it afterwards
+        output = compression.with_suffix(target, ".nii")
+        self.actions = [["ImageMath", "3", output, "-", lhs, rhs]]
+        if output != str(target):
+            self.actions.extend([
+                (compression.copy, (output, target, level)), ["rm", output]])
+
+class ApplyTransforms(spire.TaskFactory):
+    """ Apply transforms with antsApplyTransforms, compressing the output 
+        according to the output policy.
+    """
+    
+    def __init__(self, source, reference, transforms, target, level=None):
+        spire.TaskFactory.__init__(self, str(target))
+        self.file_dep = [source, reference]+list(transforms)
+        self.targets = [target]
+        
+        # Let antsApplyTransforms write an uncompressed image, compress it 
+        # afterwards
+        output = compression.with_suffix(target, ".nii")
+        self.actions = [
+            ["antsApplyTransforms", "-i", source, "-r", reference]
+            + list(itertools.chain(*[["-t", x] for x in transforms]))
+            + ["-o", output]]
+        if output != str(target):
+            self.actions.extend([
+                (compression.copy, (output, target, level)), ["rm", output]])
 
 class MakeLink(spire.TaskFactory):
     def __init__(self, source, target):
@@ -226,18 +265,95 @@ class CHARMLabels(spire.TaskFactory):
             yaml.dump(labels, fd)
 
 class CHARMVolume(spire.TaskFactory):
-    def __init__(self, source, volume, target):
+    """ Extract one level of the CHARM/SARM atlases, optionally as a label
+        image of given integer dtype.
+    """
+    
+    def __init__(self, source, volume, target, dtype=None):
         spire.TaskFactory.__init__(self, str(target))
         self.file_dep = [source]
         self.targets = [target]
         self.actions = [
-            (CHARMVolume.extract_volume, (source, volume, target))]
+            (CHARMVolume.extract_volume, (source, volume, target, dtype))]
+    
+    @staticmethod
+    def extract_volume(source, volume, target, dtype=None):
+        image = nibabel.load(source)
+        volume = CHARMVolume.level_index(image, volume)
+        # Slice the proxy: only the requested level is loaded in memory
+        volume = numpy.asarray(image.dataobj[..., 0, volume])
+        compression.save(
+            CHARMVolume.label_image(volume, image.affine, dtype), target)
+    
+    @staticmethod
+    def level_index(image, volume):
+        """ Return the non-negative index of a level of the atlas, accepting 
+            negative indices as Python sequences do.
+        """
+        
+        count = image.shape[-1]
+        try:
+            return range(count)[volume]
+        except IndexError:
+            raise ValueError(
+                "No level {} in atlas with {} levels".format(volume, count))
+    
+    @staticmethod
+    def label_image(volume, affine, dtype=None):
+        """ Create a NIfTI image from a level of the atlas. If dtype is given,
+            the level is rounded and stored as labels of this integer type.
+        """
+        
+        if dtype is not None:
+            if not numpy.issubdtype(dtype, numpy.integer):
+                raise TypeError(
+                    "Label images must have an integer dtype, not {}".format(
+                        numpy.dtype(dtype)))
+            if not numpy.isfinite(volume).all():
+                raise ValueError("Labels must be finite")
+            volume = numpy.round(volume)
+            info = numpy.iinfo(dtype)
+            if volume.size > 0:
+                low, high = volume.min(), volume.max()
+                if low < info.min or high > info.max:
+                    raise ValueError(
+                        "Labels in [{}, {}] do not fit in {}".format(
+                            low, high, numpy.dtype(dtype)))
+            volume = volume.astype(dtype)
+        return nibabel.Nifti1Image(volume, affine)
+
+class CHARMVolumes(spire.TaskFactory):
+    """ Extract several levels of the CHARM/SARM atlases from a single read of
+        the source, optionally as label images of given integer dtype.
+    """
+    
+    def __init__(self, source, volumes, targets, dtype=None):
+        if not volumes:
+            raise ValueError("No volume to extract")
+        if len(volumes) != len(targets):
+            raise ValueError(
+                "Got {} volumes but {} targets".format(
+                    len(volumes), len(targets)))
+        
+        spire.TaskFactory.__init__(self, str(targets[0]))
+        self.file_dep = [source]
+        self.targets = targets
+        self.actions = [
+            (CHARMVolumes.extract_volumes, (source, volumes, targets, dtype))]
     
     @staticmethod
-    def extract_volume(source, volume, target):
+    def extract_volumes(source, volumes, targets, dtype=None):
         image = nibabel.load(source)
-        volume = numpy.array(image.dataobj)[..., 0, volume]
-        nibabel.save(nibabel.Nifti1Image(volume, image.affine), target)
+        volumes = [CHARMVolume.level_index(image, x) for x in volumes]
+        # The levels are stored last on disk: read the range covering all 
+        # requested levels at once instead of decompressing once per level.
+        first, last = min(volumes), max(volumes)
+        data = numpy.asarray(image.dataobj[..., 0, first:last+1])
+        for volume, target in zip(volumes, targets):
+            compression.save(
+                CHARMVolume.label_image(
+                    data[..., volume-first], image.affine, dtype),
+                target)
 
 class ClustersVolumeReport(spire.TaskFactory):
     def __init__(self, clusters, atlas, labels, report, min_size=None):
@@ -262,4 +378,5 @@ class AverageImages(spire.TaskFactory):
     def average_images(sources, target):
         images = [nibabel.load(x) for x in sources]
         average = numpy.average([x.get_fdata() for x in images], 0)
-        nibabel.save(nibabel.Nifti1Image(average, images[0].affine), target)
+        compression.save(
+            nibabel.Nifti1Image(average, images[0].affine), target)
@@ -2,6 +2,8 @@ import nibabel
 import numpy
 import scipy.stats
 
+import compression
+
 def test(groups, mask, t_map, p_map, z_map):
     images = [[nibabel.load(x) for x in g] for g in groups]
     if mask is not None:
@@ -27,6 +29,6 @@ def test(groups, mask, t_map, p_map, z_map):
         arrays[index] = array
     
     t, p, z = arrays
-    nibabel.save(nibabel.Nifti1Image(t, image.affine), t_map)
-    nibabel.save(nibabel.Nifti1Image(p, image.affine), p_map)
-    nibabel.save(nibabel.Nifti1Image(z, image.affine), z_map)
+    compression.save(nibabel.Nifti1Image(t, image.affine), t_map)
+    compression.save(nibabel.Nifti1Image(p, image.affine), p_map)
+    compression.save(nibabel.Nifti1Image(z, image.affine), z_map)